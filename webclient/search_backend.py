@@ -1,17 +1,21 @@
+import asyncio
+import collections
 import concurrent.futures
 import glob
-import json
+import hashlib
+import io
 import os
 import re
 import threading
-import requests
 import traceback
-from typing import Annotated, List, Generator, Optional
+from typing import Annotated, List, AsyncGenerator, Optional
 
 from fastapi import HTTPException
 from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse
 import httpx
 from loguru import logger
+import orjson
+import zstandard as zstd
 
 import leptonai
 from leptonai import Client
@@ -29,21 +33,61 @@ SEARCHAPI_SEARCH_ENDPOINT = "https://www.searchapi.io/api/v1/search"
 # reference count
 REFERENCES_COUNT = 4
 
+# number of results requested from the search engines, rounded up to a multiple of 10
+_SEARCH_NUM = (
+    REFERENCES_COUNT
+    if REFERENCES_COUNT % 10 == 0
+    else (REFERENCES_COUNT // 10 + 1) * 10
+)
+
+# constant end of the serper request body
+_SERPER_PAYLOAD_TAIL = b',"num":' + str(_SEARCH_NUM).encode() + b'}'
+
+# citation prefixes of the contexts, the search functions return at most REFERENCES_COUNT of them
+_CITE = tuple(f"[[citation:{i}]] " for i in range(1, REFERENCES_COUNT + 1))
+
 # return error after exceeding the limit below
 DEFAULT_SEARCH_ENGINE_TIMEOUT = 5
 
+# timeout and connection pool of the http/2 clients used to talk to the llm
+_LLM_TIMEOUT = httpx.Timeout(connect=10, read=120, write=120, pool=10)
+_LLM_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+
+# number of kv results kept in process memory
+KV_CACHE_SIZE = 512
+
+# size of the slices stored results are streamed back in
+KV_STREAM_CHUNK_SIZE = 8192
+
+# number of kv writes allowed to be pending, further writes are dropped
+KV_PUT_QUEUE_SIZE = 64
+
+# seconds a request waits for an identical in-flight query before generating on its own
+INFLIGHT_TIMEOUT = 120
+
+# prefix of zstd compressed KV values, values without it are stored uncompressed
+_KV_ZSTD_MAGIC = b"\x01"
+
+# number of system prompts / related questions kept per contexts fingerprint
+CONTEXTS_CACHE_SIZE = 512
+
+# instruction tags stripped from the user query
+_INST_RE = re.compile(r"\[/?INST\]")
 
 # def query
 def_query = "Which character on the show 'The Big Bang Theory' idolizes Spock the most?"
 
-# rag query
+# rag query, the static instructions that start the system prompt
 _rag_query_text = """
 You are a large language AI assistant. You are given a user question, and please write clean, concise and accurate answer to the question. You will be given a set of related contexts to the question, each starting with a reference number like [[citation:x]], where x is a number. Please use the context and cite the context at the end of each sentence if applicable.
 
 Your answer must be correct, accurate and written by an expert using an unbiased and professional tone. Please limit to 1024 tokens. Do not give any information that is not related to the question, and do not repeat. Say "information is missing on" followed by the related topic, if the given context do not provide sufficient information.
 
 Please cite the contexts with the reference numbers, in the format [citation:x]. If a sentence comes from multiple contexts, please list all applicable citations, like [citation:3][citation:5]. Other than code and specific names and citations, your answer must be written in the same language as the question.
+"""
 
+# rag contexts, appended to the static query text
+_rag_context_text = """
 Here are the set of contexts:
 
 {context}
@@ -51,6 +95,11 @@ Here are the set of contexts:
 Remember, don't blindly repeat the contexts verbatim. And here is the user question:
 """
 
+# separators of the streamed response, pre-encoded for the asgi send path
+_SEP_LLM = b"\n___LLM_RESPONSE___\n"
+_SEP_RQ = b"\n\n__RELATED_QUESTIONS__\n\n"
+_NO_CTX = b"Could not get the context as the search engine did not return any answer for this query."
+
 # stop words for removal
 stop_words = [
     "<|im_end|>",
@@ -63,7 +112,9 @@ stop_words = [
 
 _more_questions_prompt = """
 You are a helpful assistant that helps the user to ask related questions, based on user's original question and the related contexts. Please identify worthwhile topics that can be follow-ups, and write questions no longer than 20 words each. Please make sure that specifics, like events, names, locations, are included in follow up questions so they can be asked standalone. For example, if the original question asks about "the Manhattan project", in the follow up question, do not just say "the project", but use the full name "the Manhattan project". Your related questions must be in the same language as the original question.
+"""
 
+_more_questions_context_text = """
 Here are the contexts of the question:
 
 {context}
@@ -72,35 +123,55 @@ Remember, based on the original question and related contexts, suggest three suc
 """
 
 
-def search_with_serper(query: str, key: str):
+def contexts_fingerprint(contexts) -> bytes:
+    """
+    Fingerprint of the (url, snippet) pairs of the contexts, used as a cache key
+    """
+    return hashlib.blake2b(
+        b"\0".join(
+            c["url"].encode() + b"|" + c["snippet"].encode() for c in contexts
+        ),
+        digest_size=16
+    ).digest()
+
+
+async def _chunk(b: bytes, n: int = KV_STREAM_CHUNK_SIZE) -> AsyncGenerator[bytes, None]:
+    """
+    Yields the bytes in slices of n bytes, async so starlette doesn't iterate it in a threadpool
+    """
+    for i in range(0, len(b), n):
+        yield b[i:i + n]
+
+
+def _bounded_put(cache: dict, keys: collections.deque, key, value, maxsize: int):
+    """
+    Puts the value in the cache, evicting the oldest entry once maxsize is exceeded
+    """
+    cache[key] = value
+    keys.append(key)
+    if len(keys) > maxsize:
+        cache.pop(keys.popleft(), None)
+
+
+async def search_with_serper_async(query: str, key: str, client: httpx.AsyncClient):
     """
     Search with Serper API and return the contexts
     """
-    payload = json.dumps(
-        {
-            "q": query,
-            "num": (
-                REFERENCES_COUNT 
-                if REFERENCES_COUNT % 10 == 0 
-                else (REFERENCES_COUNT // 10 + 1) * 10
-            ),
-        }
-    )
+    # only the query varies, orjson takes care of escaping it
+    payload = b'{"q":' + orjson.dumps(query) + _SERPER_PAYLOAD_TAIL
 
-    headers = {"X-API-KEY": key, "ContentType": "application/json"}
-    logger.info(
-        f'{payload} {headers} {key} {query} {SERPER_SEARCH_ENDPOINT}'
-    )
-    response = requests.post(
+    headers = {"X-API-KEY": key, "Content-Type": "application/json"}
+    logger.debug(
+        "search req q={q} endpoint={e}", q=query, e=SERPER_SEARCH_ENDPOINT)
+    response = await client.post(
         SERPER_SEARCH_ENDPOINT,
         headers=headers,
-        data=payload,
-        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
+        content=payload,
     )
-    if not response.ok:
+    if not response.is_success:
         logger.error(f"{response.status_code} {response.text}")
         raise HTTPException(response.status_code, "search engine error.")
-    content = response.json()
+    content = orjson.loads(response.content)
     try:
         contexts = []
         if content.get('knowledgeGraph'):
@@ -126,43 +197,39 @@ def search_with_serper(query: str, key: str):
 
         contexts += [
             {"name": c["title"], "url": c["link"],
-                "snippet": c.get["snippet", ""]}
+                "snippet": c.get("snippet", "")}
             for c in content["organic"]
         ]
         return contexts[:REFERENCES_COUNT]
-    except KeyError:
-        logger.error(f'Error encountered : {content}')
+    except (KeyError, TypeError):
+        # truncated, the raw response can be large
+        logger.error(f'Error encountered : {str(content)[:512]}')
     return []
 
 
-def search_with_searchapi(query: str, key: str):
+async def search_with_searchapi_async(query: str, key: str, client: httpx.AsyncClient):
     """
     Search with SearchAPI.io and return the contexts
     """
     payload = {
         "q": query,
         "engine": "google",
-        "num": (
-            REFERENCES_COUNT
-            if REFERENCES_COUNT % 10 == 0
-            else (REFERENCES_COUNT // 10 + 1) * 10
-        ),
+        "num": _SEARCH_NUM,
     }
     headers = {"Authorization": f"Bearer {key}",
                "Content-Type": "application/json"}
-    logger.info(
-        f"{payload} {headers} {key} {query} {SEARCHAPI_SEARCH_ENDPOINT}"
-    )
-    response = requests.get(
+    logger.debug(
+        "search req q={q} endpoint={e}", q=query, e=SEARCHAPI_SEARCH_ENDPOINT)
+    response = await client.get(
         SEARCHAPI_SEARCH_ENDPOINT,
         headers=headers,
         params=payload,
-        timeout=30
+        timeout=httpx.Timeout(connect=5, read=30, write=5, pool=5)
     )
-    if not response.ok:
+    if not response.is_success:
         logger.error(f"{response.status_code} {response.text}")
         raise HTTPException(response.status_code, "Search engine error.")
-    json_content = response.json()
+    json_content = orjson.loads(response.content)
     try:
         # get contexts
         contexts = []
@@ -227,6 +294,9 @@ def search_with_searchapi(query: str, key: str):
 class RAG(Photon):
     requirement_dependency = [
         "openai",  # for openai client usage.
+        "orjson",  # for fast (de)serialization of payloads.
+        "httpx[http2]",  # for pooled http/2 connections to the search engines and the llm.
+        "zstandard",  # for compressing the results stored in the KV.
     ]
     extra_files = glob.glob("ui/**/*", recursive=True)
     deployment_template = {
@@ -260,24 +330,33 @@ class RAG(Photon):
         If using OpenAI API
         '''
         import openai
-        thread_local = threading.local()
-        try:
-            return thread_local.client
-        except AttributeError:
-            thread_local.client = openai.OpenAI(
+        client = getattr(self._tls, "client", None)
+        if client is None:
+            self._tls.client = client = openai.OpenAI(
                 base_url=f"https://{self.model}.lepton.run/api/v1/",
                 api_key=os.environ.get("LEPTON_WORKSPACE_TOKEN")
                 or WorkspaceInfoLocalRecord.get_current_workspace_token(),
-                timeout=httpx.Timeout(
-                    connect=10, read=120, write=120, pool=10),
+                timeout=_LLM_TIMEOUT,
+                http_client=httpx.Client(
+                    http2=True, limits=_LLM_LIMITS, timeout=_LLM_TIMEOUT),
             )
-            return thread_local.client
+        return client
 
     def init(self):
         '''
         Initialize Photon Configs
         '''
+        import openai
         leptonai.api.workspace.login()
+        # per thread openai clients, created lazily by local_client
+        self._tls = threading.local()
+        # shared, pooled client for the search engines so that connections are kept alive
+        self._ahttp = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(
+                connect=5, read=DEFAULT_SEARCH_ENGINE_TIMEOUT, write=5, pool=5),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
         self.backend = os.environ["BACKEND"].upper()
         if self.backend == "LEPTON":
             self.leptonsearch_client = Client(
@@ -290,24 +369,41 @@ class RAG(Photon):
             )
         elif self.backend == "SERPER":
             self.search_api_key = os.environ["SERPER_API_KEY"]
-            self.search_function = lambda query: search_with_serper(
+            self.search_function = lambda query: search_with_serper_async(
                 query,
-                self.search_api_key
+                self.search_api_key,
+                self._ahttp
             )
         elif self.backend == "SEARCHAPI":
             self.search_api_key = os.environ["SEARCHAPI_API_KEY"]
-            self.search_function = lambda query: search_with_searchapi(
+            self.search_function = lambda query: search_with_searchapi_async(
                 query,
-                self.search_api_key
+                self.search_api_key,
+                self._ahttp
             )
         else:
             raise RuntimeError(
                 "Backend must be LEPTON, SERPER or SEARCHAPI.")
         self.model = os.environ["LLM_MODEL"]
+        # async client used by the request handlers to stream the answer
+        self._allm = openai.AsyncOpenAI(
+            base_url=f"https://{self.model}.lepton.run/api/v1/",
+            api_key=os.environ.get("LEPTON_WORKSPACE_TOKEN")
+            or WorkspaceInfoLocalRecord.get_current_workspace_token(),
+            timeout=_LLM_TIMEOUT,
+            http_client=httpx.AsyncClient(
+                http2=True, limits=_LLM_LIMITS, timeout=_LLM_TIMEOUT),
+        )
         self.executor = concurrent.futures.ThreadPoolExecutor(
-            # An exector to carry out async tasks, such as uploading to KV.
+            # An exector to carry out async tasks, such as generating related questions.
             max_workers=self.handler_max_concurrency * 2
         )
+        # KV uploads get their own executor so slow writes don't starve the LLM calls
+        self.kv_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self._kv_put_slots = threading.BoundedSemaphore(KV_PUT_QUEUE_SIZE)
+        # only used from the event loop, the (de)compressors are not thread safe
+        self._zc = zstd.ZstdCompressor(level=3)
+        self._zd = zstd.ZstdDecompressor()
         # Create the KV to store the search results.
         logger.info("Creating KV. May take a while for the first time.")
         self.kv = KV(
@@ -315,6 +411,59 @@ class RAG(Photon):
         )
         self.should_do_related_questions = to_bool(
             os.environ['RELATED_QUESTIONS'])
+        # bounded in-process cache in front of the KV, oldest entries are evicted first
+        self._kv_cache: dict[str, bytes] = {}
+        self._kv_cache_keys = collections.deque()
+        # caches keyed by the contexts fingerprint, so repeated contexts skip the work
+        self._prompt_cache: dict[bytes, str] = {}
+        self._prompt_cache_keys = collections.deque()
+        self._rq_cache: dict[tuple, list] = {}
+        self._rq_cache_keys = collections.deque()
+        # identical queries being generated, later callers replay the first one's result
+        self._inflight: dict[str, asyncio.Future] = {}
+        # running generation tasks, referenced so they aren't garbage collected mid-stream
+        self._generations: set[asyncio.Task] = set()
+
+    def _kv_put(self, search_uuid, result: bytes):
+        '''
+        Uploads the result to the KV in the background
+        '''
+        if not self._kv_put_slots.acquire(blocking=False):
+            # in favor of availability, the result is generated again on the next request
+            logger.warning(f"Too many pending KV writes, not storing {search_uuid}.")
+            return
+        future = self.kv_executor.submit(
+            self.kv.put, search_uuid, _KV_ZSTD_MAGIC + self._zc.compress(result))
+        future.add_done_callback(lambda _: self._kv_put_slots.release())
+
+    def _finish_flight(self, flight_key, flight, result: Optional[bytes]):
+        '''
+        Hands the result to the waiting identical queries, None makes them generate on their own
+        '''
+        if flight is None:
+            return
+        if self._inflight.get(flight_key) is flight:
+            del self._inflight[flight_key]
+        if not flight.done():
+            flight.set_result(result)
+
+    async def _kv_get(self, search_uuid):
+        '''
+        Gets the stored result from the in-process cache, falling back to the KV
+        '''
+        result = self._kv_cache.get(search_uuid)
+        if result is not None:
+            return result
+        raw = await asyncio.to_thread(self.kv.get, search_uuid)
+        if isinstance(raw, str):
+            raw = raw.encode()
+        if raw[:1] == _KV_ZSTD_MAGIC:
+            result = self._zd.decompress(raw[1:])
+        else:
+            result = raw
+        _bounded_put(
+            self._kv_cache, self._kv_cache_keys, search_uuid, result, KV_CACHE_SIZE)
+        return result
 
     def get_related_questions(self, query, contexts):
         '''
@@ -336,14 +485,19 @@ class RAG(Photon):
             '''
             pass
 
+        # the questions also depend on the query, so it is part of the key
+        cache_key = (contexts_fingerprint(contexts), query)
+        cached = self._rq_cache.get(cache_key)
+        if cached is not None:
+            return cached
         try:
             response = self.local_client().chat.completions.create(
                 model=self.model,
                 messages=[
                     {
                         "role": "system",
-                        "content": _more_questions_prompt.format(
-                            context="\n\n".join([c["snippet"] for c in contexts])
+                        "content": _more_questions_prompt + _more_questions_context_text.format(
+                            context="\n\n".join(c["snippet"] for c in contexts)
                         ),
                     },
                     {
@@ -359,9 +513,13 @@ class RAG(Photon):
             )
             related = response.choices[0].message.tool_calls[0].function.arguments
             if isinstance(related, str):
-                related = json.loads(related)
+                related = orjson.loads(related)
             logger.trace(f"Related questions {related}")
-            return related['questions'][:5]
+            related_questions = related['questions'][:5]
+            _bounded_put(
+                self._rq_cache, self._rq_cache_keys, cache_key,
+                related_questions, CONTEXTS_CACHE_SIZE)
+            return related_questions
         except Exception as e:
             logger.error(
                 "encountered an error while generating related responses:"
@@ -369,50 +527,73 @@ class RAG(Photon):
             )
             return []
 
-    def _raw_stream_response(
+    async def _raw_stream_response(
         self, contexts, llm_response, related_questions_future
-    ) -> Generator[str, None, None]:
+    ) -> AsyncGenerator[bytes, None]:
         """
-        A function which yields the raw stream response
+        A function which yields the raw stream response, already encoded
         """
-        yield json.dumps(contexts)
-        yield "\n___LLM_RESPONSE___\n"
+        yield orjson.dumps(contexts)
+        yield _SEP_LLM
         if not contexts:
-            yield (
-                f"Could not get the context as the search engine did not return any answer for this query."
-            )
-        for chunk in llm_response:
+            yield _NO_CTX
+        async for chunk in llm_response:
             if chunk.choices:
-                yield chunk.choices[0].delta.content or ""
+                yield (chunk.choices[0].delta.content or "").encode()
         if related_questions_future is not None:
-            related_questions = related_questions_future.result()
+            related_questions = await asyncio.wrap_future(related_questions_future)
             try:
-                result = json.dumps(related_questions)
+                result = orjson.dumps(related_questions)
             except Exception as e:
                 logger.error(
                     f"'Encountered error' {e}\n {traceback.format_exc()}"
                 )
-                result = "[]"
-            yield "\n\n__RELATED_QUESTIONS__\n\n"
+                result = b"[]"
+            yield _SEP_RQ
             yield result
 
-    def stream_and_upload_to_kv(
-        self, contexts, llm_response, related_questions_future, search_uuid
-    ) -> Generator[str, None, None]:
+    async def stream_and_upload_to_kv(
+        self, contexts, llm_response, related_questions_future, search_uuid,
+        chunks: asyncio.Queue, flight_key=None, flight=None
+    ):
         """
-        Streams the result and uploads to KV
+        Streams the result into chunks and uploads to KV
+
+        Runs in its own task, so the generation finishes for the identical queries
+        waiting on it even if the client that started it disconnects.
         """
-        all_yielded_responses = []
-        for result in self._raw_stream_response(
-            contexts, llm_response, related_questions_future
-        ):
-            all_yielded_responses.append(result)
-            yield result
-        _ = self.executor.submit(
-            self.kv.put, search_uuid,"".join(all_yielded_responses))
+        buf = io.BytesIO()
+        result = None
+        try:
+            async for chunk in self._raw_stream_response(
+                contexts, llm_response, related_questions_future
+            ):
+                buf.write(chunk)
+                chunks.put_nowait(chunk)
+            result = buf.getvalue()
+        except Exception as e:
+            logger.error(
+                f"encountered error while streaming : {e}\n{traceback.format_exc()}"
+            )
+            if related_questions_future is not None:
+                related_questions_future.cancel()
+        finally:
+            # hands the pooled connection back, also when the stream was cut short
+            await llm_response.close()
+            self._finish_flight(flight_key, flight, result)
+            chunks.put_nowait(None)
+        if result is not None:
+            self._kv_put(search_uuid, result)
+
+    async def _stream_chunks(self, chunks: asyncio.Queue) -> AsyncGenerator[bytes, None]:
+        """
+        Yields the chunks of a running generation until it is done
+        """
+        while (chunk := await chunks.get()) is not None:
+            yield chunk
 
     @Photon.handler(method="POST", path="/query")
-    def query_function(
+    async def query_function(
         self,
         query: str,
         search_uuid: str,
@@ -432,12 +613,8 @@ class RAG(Photon):
         """
         if search_uuid:
             try:
-                result = self.kv.get(search_uuid)
-
-                def str_to_generator(result: str) -> Generator[str, None, None]: 
-                    yield result
-
-                return StreamingResponse(str_to_generator(result))
+                result = await self._kv_get(search_uuid)
+                return StreamingResponse(_chunk(result), media_type="text/html")
 
             except KeyError:
                 logger.info(
@@ -453,7 +630,9 @@ class RAG(Photon):
 
         if self.backend == "LEPTON":
             # delegating the work to the lepton search api
-            result = self.leptonsearch_client.response(
+            # the client is blocking, so keep it off the event loop
+            result = await asyncio.to_thread(
+                self.leptonsearch_client.response,
                 query=query,
                 search_uuid=search_uuid,
                 generate_related_questions=generate_related_questions
@@ -461,45 +640,91 @@ class RAG(Photon):
             return StreamingResponse(content=result, media_type="text\html")
 
         query = query or def_query
-        query = re.sub(r"\[/?INST\]", "", query)
-        contexts = self.search_function(query)
+        query = _INST_RE.sub("", query)
+        # lone surrogates can't be encoded by orjson or sent upstream, replace them once here
+        query = query.encode("utf-8", "replace").decode()
+
+        flight_key = hashlib.sha1(
+            f"{self.backend}\x00{bool(generate_related_questions)}\x00{query}".encode(
+                "utf-8", "surrogatepass")
+        ).hexdigest()
+        flight = self._inflight.get(flight_key)
+        if flight is not None:
+            try:
+                # shielded, so a disconnecting caller doesn't cancel it for everyone
+                result = await asyncio.wait_for(
+                    asyncio.shield(flight), timeout=INFLIGHT_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Identical query still running, generating {search_uuid} again.")
+                self._finish_flight(flight_key, flight, None)
+                result = None
+            if result is not None:
+                self._kv_put(search_uuid, result)
+                return StreamingResponse(_chunk(result), media_type="text/html")
+            flight = None
+        else:
+            flight = asyncio.get_running_loop().create_future()
+            self._inflight[flight_key] = flight
 
-        system_prompt = _rag_query_text.format(
-            context="\n\n".join(
-                [f"[[citation:{i+1}]] {c['snippet']}" for i, c in enumerate(contexts)]
-            )
-        )
+        related_questions_future = None
         try:
-            client = self.local_client()
-            llm_response = client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query},
-                ],
-                max_tokens=1024,
-                stop=stop_words,
-                stream=True,
-                temperature=0.9
-            )
+            contexts = await self.search_function(query)
             if self.should_do_related_questions and generate_related_questions:
-                # generating related questions as the answer is being generated
+                # related questions only need the contexts, so start them before the answer
                 related_questions_future = self.executor.submit(
                     self.get_related_questions, query, contexts
                 )
-            else:
-                related_questions_future = None
-        except Exception as e:
-            logger.error(
-                f"encountered error : {e}\n{traceback.format_exc()}"
+
+            fingerprint = contexts_fingerprint(contexts)
+            system_prompt = self._prompt_cache.get(fingerprint)
+            if system_prompt is None:
+                system_prompt = _rag_query_text + _rag_context_text.format(
+                    context="\n\n".join(
+                        _CITE[i] + c["snippet"] for i, c in enumerate(contexts)
+                    )
+                )
+                _bounded_put(
+                    self._prompt_cache, self._prompt_cache_keys, fingerprint,
+                    system_prompt, CONTEXTS_CACHE_SIZE)
+            try:
+                llm_response = await self._allm.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": query},
+                    ],
+                    max_tokens=1024,
+                    stop=stop_words,
+                    stream=True,
+                    temperature=0.9
+                )
+            except Exception as e:
+                logger.error(
+                    f"encountered error : {e}\n{traceback.format_exc()}"
+                )
+                if related_questions_future is not None:
+                    related_questions_future.cancel()
+                self._finish_flight(flight_key, flight, None)
+                return HTMLResponse("Internal Server Error.", 503)
+            chunks = asyncio.Queue()
+            generation = asyncio.create_task(
+                self.stream_and_upload_to_kv(
+                    contexts, llm_response, related_questions_future, search_uuid,
+                    chunks, flight_key, flight
+                )
             )
-            return HTMLResponse("Internal Server Error.", 503)
-        return StreamingResponse(
-            self.stream_and_upload_to_kv(
-                contexts, llm_response, related_questions_future, search_uuid
-            ),
-            media_type="text/html"
-        )
+            self._generations.add(generation)
+            generation.add_done_callback(self._generations.discard)
+            return StreamingResponse(
+                self._stream_chunks(chunks),
+                media_type="text/html"
+            )
+        except BaseException:
+            # anything escaping here, including a disconnect, must not leave the flight pending
+            if related_questions_future is not None:
+                related_questions_future.cancel()
+            self._finish_flight(flight_key, flight, None)
+            raise
 
     @Photon.handler(mount=True)
     def ui(self):